@@ -1,5 +1,12 @@
-import os, sqlite3, secrets, statistics, math, requests, stripe, datetime
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify, flash
+import os, sqlite3, secrets, math, stripe, datetime, queue, threading, time, re, hashlib, gzip
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, closing
+from dataclasses import dataclass, asdict
+import httpx
+import numpy as np
+import orjson
+from flask import Flask, render_template, request, redirect, url_for, session, flash, Response, stream_with_context
 
 # -------------------- Config --------------------
 app = Flask(__name__)
@@ -13,31 +20,116 @@ STRIPE_PUBLISHABLE_KEY = os.getenv("STRIPE_PUBLISHABLE_KEY")
 # eBay
 EBAY_APP_ID = os.getenv("EBAY_APP_ID")  # required for searches
 
+# One keep-alive HTTP/2 client for all eBay calls: no TCP+TLS handshake per request, and
+# concurrent page requests multiplex over a single connection
+EBAY_HTTP = httpx.Client(
+    timeout=25, headers={"User-Agent": "BargainFinder/1.0", "Accept-Encoding": "gzip"},
+    transport=httpx.HTTPTransport(http2=True, retries=2, limits=httpx.Limits(max_connections=32, max_keepalive_connections=16)),
+)
+EBAY_RETRIES = 2  # transport retries only cover connect errors; these cover throttling/5xx responses
+EBAY_RETRY_BACKOFF = 0.3
+EBAY_RETRY_STATUSES = (429, 500, 502, 503, 504)
+# eBay calls are network-bound, so page requests fan out over a shared thread pool
+EBAY_POOL = ThreadPoolExecutor(max_workers=16)
+EBAY_URL = "https://svcs.ebay.com/services/search/FindingService/v1"
+EBAY_MAX_PAGE_SIZE = 100  # Finding API cap on paginationInput.entriesPerPage
+EBAY_MAX_FETCH = int(os.getenv("EBAY_MAX_FETCH", "1000"))  # per-search item cap, keeps one search to a few pages
+MIN_VIABLE_PRICE = 1.00  # thresholds below this almost never match a real listing, so skip the active search
+EBAY_CACHE_TTL = int(os.getenv("EBAY_CACHE_TTL", "120"))  # seconds; sold/active data moves on a scale of minutes
+
 # Basic constants
 DB = "app.db"
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
 DEFAULT_CURRENCY = "GBP"
 
 # -------------------- DB Helpers --------------------
-def db():
-    conn = sqlite3.connect(DB)
+def _connect():
+    conn = sqlite3.connect(DB, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    conn.executescript("""
+        PRAGMA synchronous=NORMAL;
+        PRAGMA mmap_size=268435456;
+        PRAGMA cache_size=-20000;
+        PRAGMA temp_store=MEMORY;
+    """)
     return conn
 
+# Warm connections are reused so SQLite's page cache survives between requests.
+# Connections are opened lazily, readers share the queue, writes go through one connection.
+_db_pool = queue.Queue(maxsize=DB_POOL_SIZE)
+_db_pool_lock = threading.Lock()
+_db_pool_opened = 0
+_db_writer = None
+_db_writer_lock = threading.Lock()
+
+def _checkout():
+    global _db_pool_opened
+    try:
+        return _db_pool.get_nowait()
+    except queue.Empty:
+        pass
+    with _db_pool_lock:
+        if _db_pool_opened < DB_POOL_SIZE:
+            _db_pool_opened += 1
+            return _connect()
+    return _db_pool.get()
+
+@contextmanager
+def db(write=False):
+    global _db_writer
+    if write:
+        with _db_writer_lock:
+            if _db_writer is None:
+                _db_writer = _connect()
+            with _db_writer as conn:
+                yield conn
+        return
+    conn = _checkout()
+    try:
+        with conn:
+            yield conn
+    finally:
+        _db_pool.put(conn)
+
+def hash_api_key(api_key):
+    # Only a truncated SHA-256 is stored; fixed 16-byte blobs keep the index small
+    return hashlib.sha256(api_key.encode()).digest()[:16]
+
 def init_db():
-    with db() as c:
-        c.execute("""CREATE TABLE IF NOT EXISTS users(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            email TEXT UNIQUE,
-            stripe_customer_id TEXT,
-            plan TEXT,
-            api_key TEXT,
-            created_at TEXT
-        )""")
-        c.execute("""CREATE TABLE IF NOT EXISTS sessions(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            created_at TEXT
-        )""")
+    # Own short-lived connection: this runs at import, and a pooled/writer connection opened here
+    # would be inherited across fork() by preloaded gunicorn workers
+    with closing(sqlite3.connect(DB)) as conn, conn as c:
+        c.row_factory = sqlite3.Row
+        # One script: WAL (persistent in the db file, lets readers run alongside the writer),
+        # then schema and indexes in a single transaction
+        c.executescript("""
+            PRAGMA journal_mode=WAL;
+            BEGIN;
+            CREATE TABLE IF NOT EXISTS users(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                email TEXT UNIQUE,
+                stripe_customer_id TEXT,
+                plan TEXT,
+                api_key_hash BLOB,
+                created_at TEXT
+            );
+            CREATE TABLE IF NOT EXISTS sessions(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                created_at TEXT
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_users_stripe_customer ON users(stripe_customer_id);
+            COMMIT;
+        """)
+        # Older databases: add the hash column, move any cleartext keys over to it and drop their index
+        cols = {r["name"] for r in c.execute("PRAGMA table_info(users)")}
+        if "api_key_hash" not in cols:
+            c.execute("ALTER TABLE users ADD COLUMN api_key_hash BLOB")
+        if "api_key" in cols:
+            for row in c.execute("SELECT id, api_key FROM users WHERE api_key IS NOT NULL").fetchall():
+                c.execute("UPDATE users SET api_key_hash=?, api_key=NULL WHERE id=?", (hash_api_key(row["api_key"]), row["id"]))
+            c.execute("DROP INDEX IF EXISTS idx_users_api_key")
+        c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_users_api_key_hash ON users(api_key_hash)")
 
 # -------------------- Auth Helpers --------------------
 def current_user():
@@ -58,26 +150,173 @@ def login_required(f):
     return wrapper
 
 # -------------------- eBay helpers --------------------
-DISALLOWED_DEFAULT = ["psa","bgs","cgc","graded","proxy","reprint","replica","lot","bundle","job lot"]
+DISALLOWED_DEFAULT = ("psa","bgs","cgc","graded","proxy","reprint","replica","lot","bundle","job lot")
+EXCLUDE_TERMS_DEFAULT = ",".join(DISALLOWED_DEFAULT)
+
+def compile_disallowed(terms):
+    # One alternation regex scans each title once instead of once per term
+    terms = [t for t in terms if t]
+    if not terms:
+        return None
+    return re.compile("|".join(re.escape(t) for t in terms), re.IGNORECASE)
+
+DISALLOWED_DEFAULT_RE = compile_disallowed(DISALLOWED_DEFAULT)
+
+SEARCH_DEFAULTS = {
+    "keywords": "vintage pokemon cards holo",
+    "global_id": "EBAY-GB",
+    "category_id": "183454",
+    "currency": DEFAULT_CURRENCY,
+    "sold_fetch": 50,
+    "min_sold_count": 12,
+    "discount_percent": 40,
+    "active_fetch": 50,
+    "exclude_terms": EXCLUDE_TERMS_DEFAULT,
+}
+
+@dataclass(slots=True)
+class SearchQuery:
+    keywords: str
+    global_id: str
+    category_id: str
+    currency: str
+    sold_fetch: int
+    min_sold_count: int
+    discount_percent: float
+    active_fetch: int
+    exclude_terms: str
+
+    @classmethod
+    def from_mapping(cls, m, defaults=SEARCH_DEFAULTS):
+        # Shared by the dashboard form and the JSON API: coerce and validate once
+        def get(k):
+            # JSON null counts as missing, like an omitted field
+            v = m.get(k)
+            return defaults[k] if v is None else v
+        q = cls(
+            keywords=str(get("keywords")).strip(),
+            global_id=str(get("global_id")).strip(),
+            category_id=str(get("category_id")).strip(),
+            currency=str(get("currency")).strip(),
+            sold_fetch=int(get("sold_fetch")),
+            min_sold_count=int(get("min_sold_count")),
+            discount_percent=float(get("discount_percent")),
+            active_fetch=int(get("active_fetch")),
+            exclude_terms=str(get("exclude_terms")),
+        )
+        if q.discount_percent <= 0 or q.discount_percent >= 100:
+            raise ValueError("Discount % must be between 1 and 99.")
+        for name in ("sold_fetch", "active_fetch"):
+            if not 0 < getattr(q, name) <= EBAY_MAX_FETCH:
+                raise ValueError(f"{name} must be between 1 and {EBAY_MAX_FETCH}.")
+        return q
 
-def contains_disallowed(title, disallowed):
-    t = (title or "").lower()
-    return any(term in t for term in disallowed)
+    @property
+    def disallowed_re(self):
+        if self.exclude_terms == EXCLUDE_TERMS_DEFAULT:
+            return DISALLOWED_DEFAULT_RE
+        return compile_disallowed(t.strip().lower() for t in self.exclude_terms.split(","))
+
+    def state(self):
+        # Form values to echo back into dashboard.html
+        return dict(asdict(self), discount_percent=int(self.discount_percent))
 
 def trimmed_mean(prices):
-    if not prices:
+    if not len(prices):
         return None
-    prices_sorted = sorted(prices)
-    n = len(prices_sorted)
+    arr = np.asarray(prices, dtype=np.float64)
+    n = arr.size
     if n < 6:
-        return statistics.median(prices_sorted)
+        return float(np.median(arr))
     trim = max(1, math.floor(n*0.15))
-    core = prices_sorted[trim:n-trim] if (n-2*trim)>=3 else prices_sorted
-    return sum(core)/len(core) if core else statistics.median(prices_sorted)
+    # Partial partition is O(n): only the two cut points need to land in sorted position
+    core = np.partition(arr, [trim, n-trim])[trim:n-trim] if (n-2*trim)>=3 else arr
+    return float(core.mean()) if core.size else float(np.median(arr))
+
+def ttl_cache(ttl):
+    # Memoize on the call arguments for `ttl` seconds; list arguments are keyed as tuples.
+    # wrapper.peek/put let streaming callers share the same cache entries.
+    def decorator(f):
+        from functools import wraps
+        cache = {}
+        lock = threading.Lock()
+        def make_key(args):
+            return tuple(tuple(a) if isinstance(a, list) else a for a in args)
+        def peek(*args):
+            with lock:
+                hit = cache.get(make_key(args))
+            return hit[1] if hit and time.monotonic() - hit[0] < ttl else None
+        def put(args, value):
+            now = time.monotonic()
+            with lock:
+                for k in [k for k, (ts, _) in cache.items() if now - ts >= ttl]:
+                    del cache[k]
+                cache[make_key(args)] = (now, value)
+        @wraps(f)
+        def wrapper(*args):
+            value = peek(*args)
+            if value is None:
+                value = f(*args)
+                put(args, value)
+            return value
+        wrapper.peek, wrapper.put = peek, put
+        return wrapper
+    return decorator
+
+def ebay_get(params):
+    for attempt in range(EBAY_RETRIES + 1):
+        r = EBAY_HTTP.get(EBAY_URL, params=params)
+        if r.status_code not in EBAY_RETRY_STATUSES or attempt == EBAY_RETRIES:
+            break
+        retry_after = r.headers.get("Retry-After", "")
+        # Honour short Retry-After hints, but never park a worker thread for long
+        time.sleep(min(float(retry_after), 5) if retry_after.isdigit() else EBAY_RETRY_BACKOFF * 2 ** attempt)
+    r.raise_for_status()
+    return orjson.loads(r.content)
 
-def get_completed_prices(app_id, keywords, global_id, category_id, currency, sold_fetch, disallowed):
-    url = "https://svcs.ebay.com/services/search/FindingService/v1"
-    params = {
+def page_params(params, total):
+    # Every page must share one entriesPerPage, otherwise eBay's page offsets don't line up
+    total = min(total, EBAY_MAX_FETCH)
+    per_page = max(1, min(EBAY_MAX_PAGE_SIZE, total))
+    return [dict(params, **{"paginationInput.entriesPerPage": str(per_page), "paginationInput.pageNumber": str(page)})
+            for page in range(1, math.ceil(total / per_page) + 1)]
+
+def page_items(data, response_key):
+    return data.get(response_key, [{}])[0].get("searchResult", [{}])[0].get("item", []) or []
+
+def total_pages(data, response_key):
+    # Missing/odd paginationOutput: assume nothing beyond the page we already have
+    try:
+        return int(data[response_key][0]["paginationOutput"][0]["totalPages"][0])
+    except (KeyError, IndexError, TypeError, ValueError):
+        return 1
+
+def fan_out_pages(params, total, response_key):
+    # Fetch page 1 inline, then submit only the further pages eBay says exist.
+    # Returns (per_page, page 1 items, {future: page index}).
+    pages = page_params(params, total)
+    if not pages:
+        return 0, [], {}
+    first = ebay_get(pages[0])
+    per_page = int(pages[0]["paginationInput.entriesPerPage"])
+    rest = pages[1:total_pages(first, response_key)]
+    futures = {EBAY_POOL.submit(ebay_get, p): i for i, p in enumerate(rest, 1)}
+    return per_page, page_items(first, response_key), futures
+
+def fetch_items(params, total, response_key):
+    # Gather in page order so results stay deterministic
+    _, items, futures = fan_out_pages(params, total, response_key)
+    try:
+        for fut in sorted(futures, key=futures.get):
+            items.extend(page_items(fut.result(), response_key))
+    finally:
+        # A failed page shouldn't leave the rest still calling eBay
+        for fut in futures:
+            fut.cancel()
+    return items[:total]
+
+def completed_params(app_id, keywords, global_id, category_id):
+    return {
         "OPERATION-NAME": "findCompletedItems",
         "SERVICE-VERSION": "1.13.0",
         "SECURITY-APPNAME": app_id,
@@ -88,35 +327,45 @@ def get_completed_prices(app_id, keywords, global_id, category_id, currency, sol
         "categoryId": category_id,
         "itemFilter(0).name": "SoldItemsOnly",
         "itemFilter(0).value": "true",
-        "paginationInput.entriesPerPage": str(sold_fetch),
         "sortOrder": "EndTimeSoonest",
     }
-    r = requests.get(url, params=params, timeout=25)
-    r.raise_for_status()
-    data = r.json()
-    items = data.get("findCompletedItemsResponse", [{}])[0].get("searchResult", [{}])[0].get("item", []) or []
-    prices = []
+
+def parse_completed(items, currency, disallowed_re):
+    prices = array("d")
+    # Bind hot names locally; cheap currency/state checks run before the title scan
+    append, to_float = prices.append, float
+    search = disallowed_re.search if disallowed_re else None
     for it in items:
-        title = it.get("title", [""])[0]
-        if contains_disallowed(title, disallowed):
+        sell = it.get("sellingStatus")
+        sell = sell[0] if sell else None
+        if not sell:
             continue
-        selling = it.get("sellingStatus", [{}])[0]
-        if selling.get("sellingState", [""])[0] != "EndedWithSales":
+        state = sell.get("sellingState")
+        if not state or state[0] != "EndedWithSales":
             continue
-        price_obj = selling.get("currentPrice", [{}])[0]
-        if price_obj.get("@currencyId") != currency:
+        cp = sell.get("currentPrice")
+        cp = cp[0] if cp else None
+        if not cp or cp.get("@currencyId") != currency:
+            continue
+        title = it.get("title")
+        if search and title and search(title[0]):
             continue
         try:
-            price = float(price_obj.get("__value__", "0"))
+            price = to_float(cp.get("__value__", "0"))
         except:
             continue
         if price > 0:
-            prices.append(price)
+            append(price)
     return prices
 
-def get_active_under(app_id, keywords, global_id, category_id, currency, active_fetch, max_price, disallowed):
-    url = "https://svcs.ebay.com/services/search/FindingService/v1"
-    params = {
+@ttl_cache(EBAY_CACHE_TTL)
+def get_completed_prices(app_id, keywords, global_id, category_id, currency, sold_fetch, disallowed_re):
+    params = completed_params(app_id, keywords, global_id, category_id)
+    items = fetch_items(params, sold_fetch, "findCompletedItemsResponse")
+    return parse_completed(items, currency, disallowed_re)
+
+def active_params(app_id, keywords, global_id, category_id, currency, max_price):
+    return {
         "OPERATION-NAME": "findItemsAdvanced",
         "SERVICE-VERSION": "1.13.0",
         "SECURITY-APPNAME": app_id,
@@ -129,40 +378,110 @@ def get_active_under(app_id, keywords, global_id, category_id, currency, active_
         "itemFilter(0).value": f"{max_price:.2f}",
         "itemFilter(0).paramName": "Currency",
         "itemFilter(0).paramValue": currency,
-        "paginationInput.entriesPerPage": str(active_fetch),
         "sortOrder": "EndTimeSoonest",
     }
-    r = requests.get(url, params=params, timeout=25)
-    r.raise_for_status()
-    data = r.json()
-    items = data.get("findItemsAdvancedResponse", [{}])[0].get("searchResult", [{}])[0].get("item", []) or []
+
+def parse_active(items, currency, disallowed_re):
     results = []
+    append, to_float = results.append, float
+    search = disallowed_re.search if disallowed_re else None
     for it in items:
-        title = it.get("title", [""])[0]
-        if contains_disallowed(title, disallowed):
+        sell = it.get("sellingStatus")
+        sell = sell[0] if sell else None
+        if not sell:
             continue
-        price_obj = it.get("sellingStatus", [{}])[0].get("currentPrice", [{}])[0]
-        if price_obj.get("@currencyId") != currency:
+        cp = sell.get("currentPrice")
+        cp = cp[0] if cp else None
+        if not cp or cp.get("@currencyId") != currency:
+            continue
+        title = it.get("title")
+        title = title[0] if title else ""
+        if search and search(title):
             continue
         try:
-            price = float(price_obj.get("__value__", "0"))
+            price = to_float(cp.get("__value__", "0"))
         except:
             continue
         if price <= 0:
             continue
-        url_item = it.get("viewItemURL", [""])[0]
-        item_id = it.get("itemId", [""])[0]
-        results.append({"id": item_id, "title": title, "price": price, "url": url_item})
+        url_item = it.get("viewItemURL")
+        item_id = it.get("itemId")
+        append({"id": item_id[0] if item_id else "", "title": title, "price": price, "url": url_item[0] if url_item else ""})
     return results
 
+@ttl_cache(EBAY_CACHE_TTL)
+def get_active_under(app_id, keywords, global_id, category_id, currency, active_fetch, max_price, disallowed_re):
+    params = active_params(app_id, keywords, global_id, category_id, currency, max_price)
+    items = fetch_items(params, active_fetch, "findItemsAdvancedResponse")
+    return parse_active(items, currency, disallowed_re)
+
+def iter_active_under(*args):
+    # Streaming variant of get_active_under: yields each page's hits as soon as that page returns,
+    # and shares get_active_under's cache so repeat searches don't hit eBay again
+    hits = get_active_under.peek(*args)
+    if hits is not None:
+        yield hits
+        return
+    app_id, keywords, global_id, category_id, currency, active_fetch, max_price, disallowed_re = args
+    params = active_params(app_id, keywords, global_id, category_id, currency, max_price)
+    per_page, first_items, futures = fan_out_pages(params, active_fetch, "findItemsAdvancedResponse")
+    by_page = {}
+    try:
+        by_page[0] = page_hits = parse_active(first_items[:active_fetch], currency, disallowed_re)
+        yield page_hits
+        for fut in as_completed(futures):
+            # Trim the last page so the total never exceeds active_fetch
+            items = page_items(fut.result(), "findItemsAdvancedResponse")[:active_fetch - futures[fut]*per_page]
+            by_page[futures[fut]] = page_hits = parse_active(items, currency, disallowed_re)
+            yield page_hits
+    finally:
+        # On an error or a disconnected client, stop pages that haven't started yet
+        for fut in futures:
+            fut.cancel()
+    get_active_under.put(args, [h for i in sorted(by_page) for h in by_page[i]])
+
+def search_stats(q):
+    # Sold-side half of every search: sample size check, trimmed mean, threshold.
+    # A "note" in the result means the active search should be skipped.
+    sold_prices = get_completed_prices(EBAY_APP_ID, q.keywords, q.global_id, q.category_id, q.currency, q.sold_fetch, q.disallowed_re)
+    # Check the sample size before paying for the mean
+    avg_price = trimmed_mean(sold_prices) if len(sold_prices) >= q.min_sold_count else None
+    if not avg_price:
+        return {"note": f"Not enough sold data (got {len(sold_prices)}).", "sold_count": len(sold_prices), "avg_price": None, "threshold": None}
+    threshold = round(avg_price * (1 - q.discount_percent/100.0), 2)
+    stats = {"sold_count": len(sold_prices), "avg_price": round(avg_price,2), "threshold": threshold}
+    if threshold < MIN_VIABLE_PRICE:
+        stats["note"] = "Threshold below viable price."
+    return stats
+
+def active_args(q, threshold):
+    return (EBAY_APP_ID, q.keywords, q.global_id, q.category_id, q.currency, q.active_fetch, threshold, q.disallowed_re)
+
 # -------------------- Routes --------------------
+_PRERENDERED = {}
+
+def prerendered(template, **ctx):
+    # Landing pages only vary by login state, so render each variant once and serve cached (gzipped) bytes
+    if "_flashes" in session:
+        return render_template(template, **ctx)
+    key = (template, bool(session.get("uid")))
+    page = _PRERENDERED.get(key)
+    if page is None:
+        html = render_template(template, **ctx).encode()
+        page = _PRERENDERED[key] = (html, gzip.compress(html))
+    headers = {"Cache-Control": "private, max-age=300", "Vary": "Accept-Encoding, Cookie"}
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return Response(page[1], headers=headers, content_type="text/html; charset=utf-8")
+    return Response(page[0], headers=headers, content_type="text/html; charset=utf-8")
+
 @app.route("/")
 def index():
-    return render_template("index.html", pk=STRIPE_PUBLISHABLE_KEY)
+    return prerendered("index.html", pk=STRIPE_PUBLISHABLE_KEY)
 
 @app.route("/pricing")
 def pricing():
-    return render_template("pricing.html", pk=STRIPE_PUBLISHABLE_KEY, price_id=STRIPE_PRICE_ID)
+    return prerendered("pricing.html", pk=STRIPE_PUBLISHABLE_KEY, price_id=STRIPE_PRICE_ID)
 
 @app.route("/create-checkout", methods=["POST"])
 def create_checkout():
@@ -187,123 +506,105 @@ def welcome():
         return redirect(url_for("pricing"))
     try:
         sess = stripe.checkout.Session.retrieve(session_id, expand=["customer"])
-        customer = sess.get("customer")
-        email = None
-        if isinstance(customer, dict):
-            email = customer.get("email")
-            customer_id = customer.get("id")
+        # customer_details is inlined on the session, so no second Customer round trip is needed.
+        # Read fields as attributes: newer stripe SDKs no longer make objects dicts
+        customer = sess.customer
+        details = sess.customer_details
+        email = details.email if details else None
+        if isinstance(customer, str):
+            customer_id = customer
         else:
-            # If only id is returned, fetch the customer
-            cust = stripe.Customer.retrieve(customer)
-            email = cust.get("email")
-            customer_id = cust.get("id")
+            customer_id = customer.id
+            email = email or customer.email
         if not email:
             email = f"user-{customer_id}@example.local"
         # upsert user
-        with db() as c:
-            row = c.execute("SELECT * FROM users WHERE stripe_customer_id=?", (customer_id,)).fetchone()
+        with db(write=True) as c:
+            row = c.execute("SELECT id FROM users WHERE stripe_customer_id=?", (customer_id,)).fetchone()
+            api_key = None
             if row:
                 uid = row["id"]
             else:
                 api_key = secrets.token_urlsafe(24)
-                c.execute("INSERT INTO users(email, stripe_customer_id, plan, api_key, created_at) VALUES(?,?,?,?,?)",
-                    (email, customer_id, "pro", api_key, datetime.datetime.utcnow().isoformat()))
-                uid = c.lastrowid
+                uid = c.execute("INSERT INTO users(email, stripe_customer_id, plan, api_key_hash, created_at) VALUES(?,?,?,?,?)",
+                    (email, customer_id, "pro", hash_api_key(api_key), datetime.datetime.utcnow().isoformat())).lastrowid
         session["uid"] = uid
-        return render_template("welcome.html")
+        # The key is only stored hashed, so this is the one chance to show it
+        return render_template("welcome.html", api_key=api_key)
     except Exception as e:
         return f"Error verifying Stripe session: {e}", 400
 
 @app.route("/dashboard", methods=["GET","POST"])
 @login_required
 def dashboard():
-    # Defaults for the form
-    defaults = {
-        "keywords": "vintage pokemon cards holo",
-        "global_id": "EBAY-GB",
-        "category_id": "183454",
-        "currency": DEFAULT_CURRENCY,
-        "sold_fetch": 50,
-        "min_sold_count": 12,
-        "discount_percent": 40,
-        "active_fetch": 50,
-        "exclude_terms": ",".join(DISALLOWED_DEFAULT),
-    }
     results = None
     if request.method == "POST":
         if not EBAY_APP_ID:
             flash("Missing EBAY_APP_ID in Replit Secrets.", "error")
-            return render_template("dashboard.html", state=defaults, results=None)
-        form = request.form
+            return render_template("dashboard.html", state=SEARCH_DEFAULTS, results=None)
         try:
-            keywords = form.get("keywords", defaults["keywords"]).strip()
-            global_id = form.get("global_id", defaults["global_id"]).strip()
-            category_id = form.get("category_id", defaults["category_id"]).strip()
-            currency = form.get("currency", defaults["currency"]).strip()
-            sold_fetch = int(form.get("sold_fetch", defaults["sold_fetch"]))
-            min_sold = int(form.get("min_sold_count", defaults["min_sold_count"]))
-            discount_percent = float(form.get("discount_percent", defaults["discount_percent"]))
-            active_fetch = int(form.get("active_fetch", defaults["active_fetch"]))
-            exclude_terms = form.get("exclude_terms", defaults["exclude_terms"])
-            disallowed = [t.strip().lower() for t in exclude_terms.split(",") if t.strip()]
-
-            if discount_percent <= 0 or discount_percent >= 100:
-                raise ValueError("Discount % must be between 1 and 99.")
-
-            sold_prices = get_completed_prices(EBAY_APP_ID, keywords, global_id, category_id, currency, sold_fetch, disallowed)
-            avg_price = trimmed_mean(sold_prices) if sold_prices else None
-
-            if not avg_price or len(sold_prices) < min_sold:
-                results = {"note": f"Not enough sold data (got {len(sold_prices)}).", "sold_count": len(sold_prices), "avg_price": avg_price, "threshold": None, "hits": []}
-            else:
-                threshold = round(avg_price * (1 - discount_percent/100.0), 2)
-                hits = get_active_under(EBAY_APP_ID, keywords, global_id, category_id, currency, active_fetch, threshold, disallowed)
-                results = {"sold_count": len(sold_prices), "avg_price": round(avg_price,2), "threshold": threshold, "hits": hits}
-            state = dict(defaults, **{
-                "keywords": keywords, "global_id": global_id, "category_id": category_id, "currency": currency,
-                "sold_fetch": sold_fetch, "min_sold_count": min_sold, "discount_percent": int(discount_percent),
-                "active_fetch": active_fetch, "exclude_terms": exclude_terms
-            })
-            return render_template("dashboard.html", state=state, results=results)
+            q = SearchQuery.from_mapping(request.form)
+            results = search_stats(q)
+            results["hits"] = [] if "note" in results else get_active_under(*active_args(q, results["threshold"]))
+            return render_template("dashboard.html", state=q.state(), results=results)
         except Exception as e:
             flash(str(e), "error")
-    return render_template("dashboard.html", state=defaults, results=results)
+    return render_template("dashboard.html", state=SEARCH_DEFAULTS, results=results)
+
+def sse(obj):
+    return b"data: " + orjson.dumps(obj) + b"\n\n"
+
+@app.route("/dashboard/stream")
+@login_required
+def dashboard_stream():
+    # Same search as the dashboard POST, streamed as Server-Sent Events: stats first, then hits per page
+    args = request.args
+
+    def generate():
+        if not EBAY_APP_ID:
+            yield sse({"type": "error", "error": "Missing EBAY_APP_ID in Replit Secrets."})
+            return
+        try:
+            q = SearchQuery.from_mapping(args)
+            stats = search_stats(q)
+            yield sse(dict(stats, type="stats"))
+            if "note" not in stats:
+                for hits in iter_active_under(*active_args(q, stats["threshold"])):
+                    yield sse({"type": "hits", "hits": hits})
+            yield sse({"type": "done"})
+        except Exception as e:
+            yield sse({"type": "error", "error": str(e)})
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+def ojson(obj, status=200):
+    # orjson encodes straight to UTF-8 bytes, skipping jsonify's str round trip
+    return Response(orjson.dumps(obj), status=status, mimetype="application/json")
+
+def cacheable(resp, max_age=60):
+    resp.headers["Cache-Control"] = f"private, max-age={max_age}"
+    return resp
 
 @app.route("/api/search", methods=["POST"])
 def api_search():
     # API: requires X-API-Key header from paying users
     api_key = request.headers.get("X-API-Key")
     if not api_key:
-        return jsonify({"ok": False, "error": "Missing X-API-Key"}), 401
+        return ojson({"ok": False, "error": "Missing X-API-Key"}, 401)
     with db() as c:
-        user = c.execute("SELECT * FROM users WHERE api_key=?", (api_key,)).fetchone()
+        user = c.execute("SELECT id, plan FROM users WHERE api_key_hash=?", (hash_api_key(api_key),)).fetchone()
         if not user:
-            return jsonify({"ok": False, "error": "Invalid API key"}), 403
-
-    data = request.get_json(force=True) or {}
-    # defaults
-    keywords = data.get("keywords", "vintage pokemon cards holo")
-    global_id = data.get("global_id", "EBAY-GB")
-    category_id = data.get("category_id", "183454")
-    currency = data.get("currency", DEFAULT_CURRENCY)
-    sold_fetch = int(data.get("sold_fetch", 50))
-    min_sold = int(data.get("min_sold_count", 12))
-    discount_percent = float(data.get("discount_percent", 40))
-    active_fetch = int(data.get("active_fetch", 50))
-    disallowed = [t.strip().lower() for t in data.get("exclude_terms","psa,bgs,cgc,graded,proxy,reprint,replica,lot,bundle,job lot").split(",") if t.strip()]
+            return ojson({"ok": False, "error": "Invalid API key"}, 403)
 
     if not EBAY_APP_ID:
-        return jsonify({"ok": False, "error": "Server missing EBAY_APP_ID"}), 500
+        return ojson({"ok": False, "error": "Server missing EBAY_APP_ID"}, 500)
     try:
-        sold_prices = get_completed_prices(EBAY_APP_ID, keywords, global_id, category_id, currency, sold_fetch, disallowed)
-        avg_price = trimmed_mean(sold_prices) if sold_prices else None
-        if not avg_price or len(sold_prices) < min_sold:
-            return jsonify({"ok": True, "note": f"Not enough sold data ({len(sold_prices)}).", "sold_count": len(sold_prices), "avg_price": avg_price, "threshold": None, "hits": []})
-        threshold = round(avg_price * (1 - discount_percent/100.0), 2)
-        hits = get_active_under(EBAY_APP_ID, keywords, global_id, category_id, currency, active_fetch, threshold, disallowed)
-        return jsonify({"ok": True, "sold_count": len(sold_prices), "avg_price": round(avg_price,2), "threshold": threshold, "hits": hits})
+        q = SearchQuery.from_mapping(request.get_json(force=True) or {})
+        stats = search_stats(q)
+        hits = [] if "note" in stats else get_active_under(*active_args(q, stats["threshold"]))
+        return cacheable(ojson(dict(stats, ok=True, hits=hits)))
     except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 400
+        return ojson({"ok": False, "error": str(e)}, 400)
 
 @app.route("/logout")
 def logout():
@@ -311,6 +612,10 @@ def logout():
     return redirect(url_for("index"))
 
 # -------------------- Startup --------------------
-if __name__ == "__main__":
+# Runs at import so gunicorn/uwsgi workers get the schema and WAL mode too
+if not app.config.get("_DB_READY"):
     init_db()
+    app.config["_DB_READY"] = True
+
+if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8080, debug=True)